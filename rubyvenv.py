@@ -1,25 +1,32 @@
 from __future__ import annotations
 
 import argparse
+import contextlib
+import fcntl
 import functools
-import gzip
-import html.parser
 import io
 import os.path
-import platform
+import re
 import shlex
 import shutil
-import tarfile
 import tempfile
-import urllib.parse
+import threading
+import time
+import urllib.error
 import urllib.request
+import zlib
+from collections.abc import Generator
+from collections.abc import Iterable
 from collections.abc import Sequence
 from typing import Callable
 from typing import ContextManager
 from typing import IO
 from typing import NamedTuple
+from typing import TYPE_CHECKING
 
-import distro
+if TYPE_CHECKING:
+    import concurrent.futures
+    import tarfile
 
 # Roughly stolen from python virtualenv 15.0.1
 ACTIVATE = '''\
@@ -90,6 +97,19 @@ export GEM_HOME
 '''
 
 
+# the rvm.io index is a plain directory listing
+_HREF_RE = re.compile(rb'href="(ruby-([^"]+)\.tar\.bz2)"')
+
+# seconds before the cached rvm.io index is revalidated
+INDEX_MAX_AGE = 24 * 60 * 60
+
+# read size for downloads and tarball streams
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# cap on file contents read ahead of the extraction threads
+EXTRACT_BUFFER_SIZE = 64 * 1024 * 1024
+
+
 class Platform(NamedTuple):
     name: str
     version: str
@@ -114,63 +134,183 @@ def get_cache_dir() -> str:
     )
 
 
-def ensure_cache_file(
-        relpath: str,
-        get_fileobj: Callable[[], ContextManager[IO[bytes]]],
-) -> str:
-    cache_dir = get_cache_dir()
-    path = os.path.join(cache_dir, relpath)
-    if os.path.exists(path):
-        return path
-    else:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        # Write to a temporary file and then rename for atomicity
-        tmpdir = os.path.join(cache_dir, 'tmp')
-        os.makedirs(tmpdir, exist_ok=True)
+def _cache_tempfile() -> IO[bytes]:
+    # Write to a temporary file and then rename for atomicity
+    tmpdir = os.path.join(get_cache_dir(), 'tmp')
+    os.makedirs(tmpdir, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=tmpdir, delete=False)
+
+
+def _replace_cache_file(dst: IO[bytes], path: str) -> None:
+    # make sure the contents are on disk before they are visible
+    dst.flush()
+    os.fsync(dst.fileno())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(dst.name, path)
+
+
+def _write_cache_file(path: str, contents: bytes) -> None:
+    with _cache_tempfile() as dst:
         try:
-            with tempfile.NamedTemporaryFile(dir=tmpdir, delete=False) as dst:
-                with get_fileobj() as src:
-                    shutil.copyfileobj(src, dst)
+            dst.write(contents)
+            _replace_cache_file(dst, path)
         except BaseException:
             os.remove(dst.name)
             raise
-        os.rename(dst.name, path)
-        return path
 
 
-def get_platform_info() -> Platform:
-    return Platform(distro.id(), distro.version(), platform.machine())
+@contextlib.contextmanager
+def _cache_lock(path: str) -> Generator[None, None, None]:
+    """Keep concurrent rubyvenv processes from downloading the same file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
 
+class _Download(io.BufferedIOBase):
+    """Save a download into the cache on a thread while `read()` follows it.
 
-class GetsAHrefs(html.parser.HTMLParser):
-    def __init__(self) -> None:
+    This overlaps waiting on the download with whatever the caller does with
+    the data (decompressing it, for instance).  The cache file is put in
+    place, and `lock` released, as soon as the download finishes.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            get_fileobj: Callable[[], ContextManager[IO[bytes]]],
+            lock: ContextManager[object],
+    ) -> None:
         super().__init__()
-        self.hrefs: list[str | None] = []
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._written = 0
+        self._pos = 0
+        self._done = False
+        self._error: BaseException | None = None
+        dst = _cache_tempfile()
+        self._src = open(dst.name, 'rb')
+        self._thread = threading.Thread(
+            target=self._save, args=(path, get_fileobj, lock, dst),
+        )
+        self._thread.start()
 
-    def handle_starttag(
+    def _save(
             self,
-            tag: str,
-            attrs: list[tuple[str, str | None]],
+            path: str,
+            get_fileobj: Callable[[], ContextManager[IO[bytes]]],
+            lock: ContextManager[object],
+            dst: IO[bytes],
     ) -> None:
-        if tag == 'a':
-            self.hrefs.append(dict(attrs)['href'])
+        error = None
+        try:
+            with lock, dst:
+                with get_fileobj() as src:
+                    while not self._stopped.is_set():
+                        chunk = src.read(COPY_BUFFER_SIZE)
+                        if not chunk or self._stopped.is_set():
+                            break
+                        dst.write(chunk)
+                        dst.flush()
+                        with self._cond:
+                            self._written += len(chunk)
+                            self._cond.notify_all()
+
+                if self._stopped.is_set():
+                    os.remove(dst.name)
+                else:
+                    _replace_cache_file(dst, path)
+        except BaseException as e:
+            os.remove(dst.name)
+            error = e
+
+        with self._cond:
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        with self._cond:
+            while not self._done and (
+                    size is None or size < 0 or self._written == self._pos
+            ):
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            if size is not None and size >= 0:
+                size = min(size, self._written - self._pos)
+
+        ret = self._src.read(size)
+        self._pos += len(ret)
+        return ret
+
+    def close(self) -> None:
+        """Stop the download, the partial file is removed by the thread."""
+        self._stopped.set()
+        self._src.close()
+        super().close()
+
+    def wait(self) -> None:
+        """Wait for the download to be saved (or to fail)."""
+        self._thread.join()
+        self._src.close()
+        if self._error is not None and not self._stopped.is_set():
+            raise self._error
+
+
+@contextlib.contextmanager
+def open_cache_file(
+        relpath: str,
+        get_fileobj: Callable[[], ContextManager[IO[bytes]]],
+) -> Generator[tuple[str, _Download | None], None, None]:
+    """Yield the path of the cache file and, on a cache miss, the download.
+
+    The download is readable while it is being saved so the caller does not
+    have to wait for (and re-read) the whole file.  It is `None` when the
+    file is already complete on disk.
+    """
+    path = os.path.join(get_cache_dir(), relpath)
+    download = None
+    if not os.path.exists(path):
+        with contextlib.ExitStack() as ctx:
+            ctx.enter_context(_cache_lock(path))
+            # another process may have downloaded it while we waited
+            if not os.path.exists(path):
+                # the download thread releases the lock once it is saved
+                download = _Download(path, get_fileobj, ctx.pop_all())
+
+    if download is None:
+        yield path, None
+    else:
+        try:
+            yield path, download
+        except BaseException:
+            download.close()
+            download.wait()
+            raise
+        else:
+            download.wait()
 
 
-def _decode_response(resp_bytes: bytes) -> str:
-    """Even though we request identity, rvm.io sends us gzip."""
-    try:
-        # Try UTF-8 first, in case they ever fix their bug
-        return resp_bytes.decode('UTF-8')
-    except UnicodeDecodeError:
-        with io.BytesIO(resp_bytes) as bytesio:
-            with gzip.GzipFile(fileobj=bytesio) as gzipfile:
-                return gzipfile.read().decode('UTF-8')
+@functools.lru_cache(maxsize=1)
+def get_platform_info() -> Platform:
+    import platform
 
+    import distro
 
-def _filename_to_version(filename: str) -> str:
-    assert filename.endswith('.tar.bz2')
-    assert filename.startswith('ruby-')
-    return filename[len('ruby-'):-1 * len('.tar.bz2')]
+    return Platform(distro.id(), distro.version(), platform.machine())
+
+
+def _decode_response(resp_bytes: bytes) -> bytes:
+    """Even though we request identity, rvm.io sends us gzip."""
+    if resp_bytes[:2] == b'\x1f\x8b':
+        return zlib.decompress(resp_bytes, wbits=16 + zlib.MAX_WBITS)
+    else:
+        return resp_bytes
 
 
 def _version_to_filename(version: str) -> str:
@@ -178,34 +318,64 @@ def _version_to_filename(version: str) -> str:
 
 
 def _download_url(platform_info: Platform, version: str) -> str:
-    return urllib.parse.urljoin(
-        platform_info.rvm_url, _version_to_filename(version),
-    )
+    return platform_info.rvm_url + _version_to_filename(version)
+
+
+def _fetch_index(platform_info: Platform) -> bytes:
+    name, version, arch = platform_info
+    filename = f'{name}-{version}-{arch}.htm'
+    path = os.path.join(get_cache_dir(), 'index', filename)
+    etag_path = f'{path}.etag'
+
+    headers = {}
+    if os.path.exists(path):
+        # recently checked: trust it without asking rvm.io again
+        if time.time() - os.path.getmtime(path) < INDEX_MAX_AGE:
+            with open(path, 'rb') as f:
+                return f.read()
+
+        if os.path.exists(etag_path):
+            with open(etag_path) as f:
+                headers['If-None-Match'] = f.read()
+
+    req = urllib.request.Request(platform_info.rvm_url, headers=headers)
+    try:
+        resp = urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            os.utime(path)
+            with open(path, 'rb') as f:
+                return f.read()
+        else:
+            raise
+
+    contents = resp.read()
+    _write_cache_file(path, contents)
+    etag = resp.headers.get('ETag')
+    if etag is not None:
+        _write_cache_file(etag_path, etag.encode())
+    else:
+        # without an etag it is simply downloaded again once it is stale
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(etag_path)
+    return contents
 
 
 def get_prebuilt_versions(platform_info: Platform) -> tuple[Version, ...]:
     url = platform_info.rvm_url
-    resp = _decode_response(urllib.request.urlopen(url).read())
-    parser = GetsAHrefs()
-    parser.feed(resp)
+    resp = _decode_response(_fetch_index(platform_info))
+    # the hrefs are bare filenames relative to the index
     return tuple(
-        Version(
-            _filename_to_version(href),
-            urllib.parse.urljoin(url, href),
-        )
-        for href in parser.hrefs
-        if href is not None and href.startswith('ruby-')
+        Version(version.decode(), url + filename.decode())
+        for filename, version in _HREF_RE.findall(resp)
     )
 
 
 def list_versions() -> int:
     platform_info = get_platform_info()
     prebuilt_versions = get_prebuilt_versions(platform_info)
-    print(
-        'Available versions for {name} {version} ({arch}):\n'.format(
-            **platform_info._asdict(),
-        ),
-    )
+    name, platform_version, arch = platform_info
+    print(f'Available versions for {name} {platform_version} ({arch}):\n')
     print('Prebuilt:')
     for version in prebuilt_versions:
         print(f'    - {version.version}')
@@ -231,33 +401,194 @@ def _write_gitignore(dest: str) -> None:
         gitignore.write('# created by rubyvenv automatically\n*\n')
 
 
-def make_environment(dest: str, version: Version) -> int:
-    platform_info = get_platform_info()
-    filename = _version_to_filename(version.version)
-    cache_file = '{name}/{version}/{arch}/{filename}'.format(
-        filename=filename, **platform_info._asdict(),
-    )
-    get_fileobj = functools.partial(urllib.request.urlopen, version.url)
-    tar_filename = ensure_cache_file(cache_file, get_fileobj)
-    dest = os.path.abspath(dest)
-    os.makedirs(dest, exist_ok=True)
-    with tarfile.open(tar_filename) as tar_file:
+def _parallel_bunzip2() -> str | None:
+    for exe in ('lbzip2', 'pbzip2'):
+        path = shutil.which(exe)
+        if path is not None:
+            return path
+    return None
+
+
+@contextlib.contextmanager
+def _open_tarball(
+        path: str,
+        download: _Download | None,
+) -> Generator[tarfile.TarFile, None, None]:
+    import subprocess
+    import tarfile
+
+    bunzip2 = _parallel_bunzip2()
+    if download is not None:
+        # still downloading: decompress it as it arrives
+        with tarfile.open(
+                fileobj=download, mode='r|bz2', bufsize=COPY_BUFFER_SIZE,
+        ) as tar_file:
+            yield tar_file
+    elif bunzip2 is None:
+        with tarfile.open(
+                path, mode='r|bz2', bufsize=COPY_BUFFER_SIZE,
+        ) as tar_file:
+            yield tar_file
+    else:
+        # bz2 blocks are independent so these decompress on all cores
+        with open(path, 'rb') as f:
+            proc = subprocess.Popen(
+                (bunzip2, '--decompress', '--stdout'),
+                stdin=f, stdout=subprocess.PIPE,
+            )
+        assert proc.stdout is not None
+        with proc:
+            with tarfile.open(
+                    fileobj=proc.stdout, mode='r|', bufsize=COPY_BUFFER_SIZE,
+            ) as tar_file:
+                yield tar_file
+            # consume the trailing padding so the decompressor exits cleanly
+            proc.stdout.read()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def _tar_members(
+        tar_file: tarfile.TarFile,
+) -> Generator[tarfile.TarInfo, None, None]:
+    for member in tar_file:
         # Remove the /cache directory.
         # It is unnecessary, and on precise it is a broken symlink
-        members = [
-            member for member in tar_file.getmembers()
-            if not member.name.endswith('/cache')
-            if '/cache/' not in member.name
-        ]
+        if member.name.endswith('/cache') or '/cache/' in member.name:
+            continue
 
         # Remove the first path segment so we extract directly into the
-        # destination directory
+        # destination directory (tar paths always use `/`)
+        _, _, member.name = member.name.partition('/')
+        if member.islnk():
+            _, _, member.linkname = member.linkname.partition('/')
+        yield member
+
+
+def _set_attrs(
+        tar_file: tarfile.TarFile,
+        member: tarfile.TarInfo,
+        path: str,
+) -> None:
+    # same as tarfile applies them (chown only happens as root)
+    tar_file.chown(member, path, False)
+    tar_file.chmod(member, path)
+    tar_file.utime(member, path)
+
+
+def _write_file(
+        tar_file: tarfile.TarFile,
+        member: tarfile.TarInfo,
+        path: str,
+        data: bytes,
+) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+    _set_attrs(tar_file, member, path)
+
+
+def _filter_member(member: tarfile.TarInfo, dest: str) -> tarfile.TarInfo:
+    import tarfile
+
+    # the extraction filters were backported to 3.9.17 / 3.11.4
+    if hasattr(tarfile, 'data_filter'):
+        return tarfile.data_filter(member, dest)
+
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+        raise tarfile.ExtractError(f'{member.name!r} is outside {dest!r}')
+    return member
+
+
+def _wait(futures: list[concurrent.futures.Future[None]]) -> None:
+    for future in futures:
+        future.result()
+    futures.clear()
+
+
+def _extract_members(
+        tar_file: tarfile.TarFile,
+        members: Iterable[tarfile.TarInfo],
+        dest: str,
+) -> None:
+    import concurrent.futures
+
+    # members written directly are filtered below, the rest by `extract`
+    tar_file.extraction_filter = _filter_member
+
+    # the archive is mostly small files, overlap their writes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        futures: list[concurrent.futures.Future[None]] = []
+        buffered = 0
+        made_dirs = set()
+        directories = []
         for member in members:
-            if os.sep in member.name:
-                _, member.name = member.name.split(os.sep, 1)
+            member = _filter_member(member, dest)
+            if member.isdir():
+                path = os.path.join(dest, member.name)
+                os.makedirs(path, exist_ok=True)
+                made_dirs.add(os.path.normpath(path))
+                # attributes are applied at the end, like `extractall`
+                directories.append(member)
+            elif member.isfile():
+                path = os.path.join(dest, member.name)
+                dirname = os.path.dirname(path)
+                if dirname not in made_dirs:
+                    os.makedirs(dirname, exist_ok=True)
+                    made_dirs.add(dirname)
+
+                # tarfile is not thread safe, read on this thread
+                src = tar_file.extractfile(member)
+                assert src is not None
+                data = src.read()
+                future = executor.submit(
+                    _write_file, tar_file, member, path, data,
+                )
+                futures.append(future)
+                buffered += len(data)
+                if buffered > EXTRACT_BUFFER_SIZE:
+                    _wait(futures)
+                    buffered = 0
             else:
-                member.name = ''
-        tar_file.extractall(dest, members)
+                # a hard link needs its target to be written
+                if member.islnk():
+                    _wait(futures)
+                tar_file.extract(member, dest)
+        _wait(futures)
+
+    # deepest first so a read-only parent does not block its children
+    directories.sort(key=lambda member: member.name, reverse=True)
+    for member in directories:
+        _set_attrs(tar_file, member, os.path.join(dest, member.name))
+
+
+def _read_sentinel(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def make_environment(dest: str, version: Version) -> int:
+    platform_info = get_platform_info()
+    filename = _version_to_filename(version.version)
+    name, platform_version, arch = platform_info
+    cache_file = f'{name}/{platform_version}/{arch}/{filename}'
+    get_fileobj = functools.partial(urllib.request.urlopen, version.url)
+    dest = os.path.abspath(dest)
+    os.makedirs(dest, exist_ok=True)
+    # skip extraction when this exact tarball was already extracted here
+    sentinel = os.path.join(dest, '.rubyvenv-version')
+    if _read_sentinel(sentinel) != version.url:
+        # a partially overwritten environment must not look extracted
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(sentinel)
+        with open_cache_file(cache_file, get_fileobj) as (path, download):
+            with _open_tarball(path, download) as tar_file:
+                _extract_members(tar_file, _tar_members(tar_file), dest)
+        with open(sentinel, 'w') as f:
+            f.write(version.url)
     _write_activate(dest)
     _write_gitignore(dest)
     return 0
@@ -1,9 +1,19 @@
 from __future__ import annotations
 
+import email.message
+import fcntl
 import io
 import os
 import platform
+import shlex
+import shutil
+import stat
 import subprocess
+import sys
+import tarfile
+import threading
+import time
+import urllib.error
 import urllib.request
 from unittest import mock
 
@@ -58,88 +68,184 @@ class RaisesAfterSomeIO:
             raise BoomError()
 
 
-def test_ensure_cache_file_file_exists(mocked_cache):
+def _downloaded_by_other_process(cache_file):
+    def flock(*args):
+        cache_file.write('foo')
+    return mock.patch.object(fcntl, 'flock', side_effect=flock)
+
+
+def test_write_cache_file(mocked_cache):
+    rubyvenv._write_cache_file(mocked_cache.join('a/b').strpath, b'hi')
+    assert mocked_cache.join('a/b').read() == 'hi'
+
+
+def test_write_cache_file_exception_safety(mocked_cache):
+    cache_file = mocked_cache.join('test.txt')
+    with mock.patch.object(os, 'fsync', side_effect=BoomError):
+        with pytest.raises(BoomError):
+            rubyvenv._write_cache_file(cache_file.strpath, b'hi')
+    assert not cache_file.exists()
+    assert mocked_cache.join('tmp').listdir() == []
+
+
+def _download(mocked_cache, get_fileobj):
+    lock = mocked_cache.ensure_dir().join('test.txt.lock').open('w')
+    path = mocked_cache.join('test.txt').strpath
+    return rubyvenv._Download(path, get_fileobj, lock), lock
+
+
+class BlocksAfterFirstRead:
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+        self.blocked = threading.Event()
+        self.release = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def read(self, size):
+        self.reads += 1
+        if self.reads > 1:
+            self.blocked.set()
+            self.release.wait()
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+def test_download(mocked_cache):
+    download, lock = _download(mocked_cache, _fileobj_func(b'hello world'))
+    assert download.readable()
+    assert download.read(5) == b'hello'
+    assert download.read() == b' world'
+    assert download.read() == b''
+    download.wait()
+    assert lock.closed
+    assert mocked_cache.join('test.txt').read() == 'hello world'
+
+
+def test_download_close_before_eof(mocked_cache):
+    src = BlocksAfterFirstRead(b'x', b'x')
+    download, _ = _download(mocked_cache, lambda: src)
+    assert download.read(1) == b'x'
+    src.blocked.wait()
+    download.close()
+    src.release.set()
+    download.wait()
+    # the download stopped instead of reading the source to the end
+    assert src.reads == 2
+    assert not mocked_cache.join('test.txt').exists()
+    assert mocked_cache.join('tmp').listdir() == []
+
+
+def test_open_cache_file_file_exists(mocked_cache):
     cache_file = mocked_cache.ensure_dir().join('test.txt')
     cache_file.write('foo')
-    ret = rubyvenv.ensure_cache_file('test.txt', _fileobj_func(b'bar'))
-    assert ret == cache_file.strpath
+    ret = rubyvenv.open_cache_file('test.txt', _fileobj_func(b'bar'))
+    with ret as (path, download):
+        assert path == cache_file.strpath
+        assert download is None
     assert cache_file.read() == 'foo'
 
 
-def test_ensure_cache_file_file_does_not_exist(mocked_cache):
+def test_open_cache_file_file_does_not_exist(mocked_cache):
     cache_file = mocked_cache.join('test.txt')
-    ret = rubyvenv.ensure_cache_file('test.txt', _fileobj_func(b'bar'))
-    assert ret == cache_file.strpath
+    src = BlocksAfterFirstRead(b'ba', b'r')
+    ret = rubyvenv.open_cache_file('test.txt', lambda: src)
+    with ret as (path, download):
+        assert path == cache_file.strpath
+        assert download is not None
+        assert download.read(2) == b'ba'
+        assert not cache_file.exists()
+        src.release.set()
+    # the unread remainder still makes it into the cache
     assert cache_file.read() == 'bar'
 
 
-def test_ensure_cache_file_makes_directories(mocked_cache):
-    cache_file = mocked_cache.join('dir/test.txt')
-    ret = rubyvenv.ensure_cache_file('dir/test.txt', _fileobj_func(b'bar'))
-    assert ret == cache_file.strpath
-    assert cache_file.read() == 'bar'
+def test_open_cache_file_downloaded_while_waiting(mocked_cache):
+    cache_file = mocked_cache.join('test.txt')
+    with _downloaded_by_other_process(cache_file):
+        ret = rubyvenv.open_cache_file('test.txt', _fileobj_func(b'bar'))
+        with ret as (path, download):
+            assert download is None
+    assert cache_file.read() == 'foo'
 
 
-def test_ensure_cache_exception_safety(mocked_cache):
+def test_open_cache_file_releases_lock_once_saved(mocked_cache):
+    cache_file = mocked_cache.join('test.txt')
+    ret = rubyvenv.open_cache_file('test.txt', _fileobj_func(b'bar'))
+    with ret as (path, download):
+        assert download is not None
+        assert download.read() == b'bar'
+        assert cache_file.read() == 'bar'
+        with open(f'{path}.lock') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_open_cache_file_exception_safety(mocked_cache):
     cache_file = mocked_cache.join('test.txt')
     with pytest.raises(BoomError):
-        rubyvenv.ensure_cache_file('test.txt', RaisesAfterSomeIO)
+        with rubyvenv.open_cache_file('test.txt', _fileobj_func(b'bar')):
+            raise BoomError()
     assert not cache_file.exists()
     assert mocked_cache.join('tmp').listdir() == []
 
 
-def test_gets_a_hrefs_trivial():
-    parser = rubyvenv.GetsAHrefs()
-    parser.feed('')
-    assert parser.hrefs == []
-
-
-def test_gets_a_hrefs_ubuntu_16_04_x86_64():
-    contents = open(resource('ubuntu_16_04_x86_64.htm')).read()
-    parser = rubyvenv.GetsAHrefs()
-    parser.feed(contents)
-    assert parser.hrefs == [
-        '../',
-        'ruby-2.0.0-p648.tar.bz2',
-        'ruby-2.1.5.tar.bz2',
-        'ruby-2.1.9.tar.bz2',
-        'ruby-2.2.5.tar.bz2',
-        'ruby-2.3.0.tar.bz2',
-        'ruby-2.3.1.tar.bz2',
+def test_open_cache_file_download_fails(mocked_cache):
+    cache_file = mocked_cache.join('test.txt')
+    with pytest.raises(BoomError):
+        with rubyvenv.open_cache_file('test.txt', RaisesAfterSomeIO):
+            pass
+    assert not cache_file.exists()
+    assert mocked_cache.join('tmp').listdir() == []
+
+
+def test_open_cache_file_download_fails_while_reading(mocked_cache):
+    with pytest.raises(BoomError):
+        with rubyvenv.open_cache_file('test.txt', RaisesAfterSomeIO) as ret:
+            _, download = ret
+            assert download is not None
+            download.read()
+    assert mocked_cache.join('tmp').listdir() == []
+
+
+def test_href_re_trivial():
+    assert rubyvenv._HREF_RE.findall(b'') == []
+
+
+def test_href_re_ubuntu_16_04_x86_64():
+    contents = open(resource('ubuntu_16_04_x86_64.htm'), 'rb').read()
+    assert rubyvenv._HREF_RE.findall(contents) == [
+        (b'ruby-2.0.0-p648.tar.bz2', b'2.0.0-p648'),
+        (b'ruby-2.1.5.tar.bz2', b'2.1.5'),
+        (b'ruby-2.1.9.tar.bz2', b'2.1.9'),
+        (b'ruby-2.2.5.tar.bz2', b'2.2.5'),
+        (b'ruby-2.3.0.tar.bz2', b'2.3.0'),
+        (b'ruby-2.3.1.tar.bz2', b'2.3.1'),
     ]
 
 
 def test_decode_response_non_gzip():
-    assert rubyvenv._decode_response(b'foo') == 'foo'
+    assert rubyvenv._decode_response(b'foo') == b'foo'
 
 
 def test_decode_response_gzip():
     contents = open(resource('ubuntu_16_04_x86_64.htm.gzip'), 'rb').read()
     ret = rubyvenv._decode_response(contents)
-    assert 'ruby-2.0.0-p648.tar.bz2' in ret
-
-
-@pytest.mark.parametrize(
-    ('filename', 'expected'),
-    (
-        ('ruby-2.0.0-p648.tar.bz2', '2.0.0-p648'),
-        ('ruby-2.3.1.tar.bz2', '2.3.1'),
-    ),
-)
-def test_filename_to_version(filename, expected):
-    assert rubyvenv._filename_to_version(filename) == expected
+    assert b'ruby-2.0.0-p648.tar.bz2' in ret
 
 
 def test_version_to_filename():
     assert rubyvenv._version_to_filename('1.2.3') == 'ruby-1.2.3.tar.bz2'
 
 
-def test_version_to_filename_filename_to_version_roundtrip():
+def test_version_to_filename_href_re_roundtrip():
     version = '1.2.3'
-    ret = version
-    ret = rubyvenv._version_to_filename(ret)
-    ret = rubyvenv._filename_to_version(ret)
-    assert ret == version
+    href = f'<a href="{rubyvenv._version_to_filename(version)}">'
+    (_, ret), = rubyvenv._HREF_RE.findall(href.encode())
+    assert ret.decode() == version
 
 
 @pytest.fixture
@@ -147,15 +253,27 @@ def xenial():
     with mock.patch.object(platform, 'machine', return_value='x86_64'):
         with mock.patch.object(distro, 'id', return_value='ubuntu'):
             with mock.patch.object(distro, 'version', return_value='16.04'):
+                rubyvenv.get_platform_info.cache_clear()
                 yield
+                rubyvenv.get_platform_info.cache_clear()
+
+
+def test_get_platform_info_is_cached():
+    rubyvenv.get_platform_info.cache_clear()
+    with mock.patch.object(distro, 'id', return_value='ubuntu') as mck:
+        rubyvenv.get_platform_info()
+        rubyvenv.get_platform_info()
+    rubyvenv.get_platform_info.cache_clear()
+    assert mck.call_count == 1
 
 
 @pytest.fixture
-def returns_xenial():
+def returns_xenial(mocked_cache):
     contents = open(resource('ubuntu_16_04_x86_64.htm.gzip'), 'rb').read()
     with mock.patch.object(urllib.request, 'urlopen') as mck:
         mck.return_value.read.return_value = contents
-        yield
+        mck.return_value.headers = {'ETag': '"57a1c5f0-1b3a"'}
+        yield mck
 
 
 @pytest.mark.usefixtures('returns_xenial')
@@ -191,6 +309,87 @@ def test_get_prebuilt_versions():
     )
 
 
+def test_get_prebuilt_versions_caches_index(mocked_cache, returns_xenial):
+    plat = rubyvenv.Platform('ubuntu', '16.04', 'x86_64')
+    rubyvenv.get_prebuilt_versions(plat)
+    (req,), _ = returns_xenial.call_args
+    assert req.full_url == 'https://rvm.io/binaries/ubuntu/16.04/x86_64/'
+    assert not req.has_header('If-none-match')
+
+    index = mocked_cache.join('index/ubuntu-16.04-x86_64.htm')
+    expected = open(resource('ubuntu_16_04_x86_64.htm.gzip'), 'rb').read()
+    assert index.read_binary() == expected
+    assert index.new(ext='htm.etag').read() == '"57a1c5f0-1b3a"'
+
+
+def test_get_prebuilt_versions_no_etag(mocked_cache, returns_xenial):
+    index = mocked_cache.join('index/ubuntu-16.04-x86_64.htm').ensure()
+    index.new(ext='htm.etag').write('"stale"')
+    index.setmtime(time.time() - rubyvenv.INDEX_MAX_AGE - 1)
+    returns_xenial.return_value.headers = {}
+    plat = rubyvenv.Platform('ubuntu', '16.04', 'x86_64')
+    assert len(rubyvenv.get_prebuilt_versions(plat)) == 6
+    # the body is still cached, but there is nothing to revalidate it with
+    expected = open(resource('ubuntu_16_04_x86_64.htm.gzip'), 'rb').read()
+    assert index.read_binary() == expected
+    assert not index.new(ext='htm.etag').exists()
+
+    # so it is served from the cache until it is stale
+    assert len(rubyvenv.get_prebuilt_versions(plat)) == 6
+    assert returns_xenial.call_count == 1
+    index.setmtime(time.time() - rubyvenv.INDEX_MAX_AGE - 1)
+    assert len(rubyvenv.get_prebuilt_versions(plat)) == 6
+    assert returns_xenial.call_count == 2
+    (req,), _ = returns_xenial.call_args
+    assert not req.has_header('If-none-match')
+
+
+def test_get_prebuilt_versions_not_modified(mocked_cache):
+    index = mocked_cache.join('index/ubuntu-16.04-x86_64.htm').ensure()
+    index.write_binary(
+        open(resource('ubuntu_16_04_x86_64.htm.gzip'), 'rb').read(),
+    )
+    index.new(ext='htm.etag').write('"57a1c5f0-1b3a"')
+    index.setmtime(time.time() - rubyvenv.INDEX_MAX_AGE - 1)
+    plat = rubyvenv.Platform('ubuntu', '16.04', 'x86_64')
+    not_modified = urllib.error.HTTPError(
+        plat.rvm_url, 304, 'Not Modified', email.message.Message(), None,
+    )
+    with mock.patch.object(
+            urllib.request, 'urlopen', side_effect=not_modified,
+    ) as mck:
+        ret = rubyvenv.get_prebuilt_versions(plat)
+    (req,), _ = mck.call_args
+    assert req.get_header('If-none-match') == '"57a1c5f0-1b3a"'
+    assert len(ret) == 6
+    # revalidated, so it is fresh again
+    assert time.time() - index.mtime() < rubyvenv.INDEX_MAX_AGE
+
+
+def test_get_prebuilt_versions_recently_cached(mocked_cache):
+    index = mocked_cache.join('index/ubuntu-16.04-x86_64.htm').ensure()
+    index.write_binary(
+        open(resource('ubuntu_16_04_x86_64.htm.gzip'), 'rb').read(),
+    )
+    plat = rubyvenv.Platform('ubuntu', '16.04', 'x86_64')
+    with mock.patch.object(urllib.request, 'urlopen') as mck:
+        ret = rubyvenv.get_prebuilt_versions(plat)
+    assert not mck.called
+    assert len(ret) == 6
+
+
+@pytest.mark.usefixtures('mocked_cache')
+def test_get_prebuilt_versions_http_error():
+    plat = rubyvenv.Platform('ubuntu', '16.04', 'x86_64')
+    error = urllib.error.HTTPError(
+        plat.rvm_url, 500, 'Internal Server Error', email.message.Message(),
+        None,
+    )
+    with mock.patch.object(urllib.request, 'urlopen', side_effect=error):
+        with pytest.raises(urllib.error.HTTPError):
+            rubyvenv.get_prebuilt_versions(plat)
+
+
 @pytest.mark.usefixtures('xenial', 'returns_xenial')
 def test_list_versions(capsys):
     ret = rubyvenv.main(('--list',))
@@ -232,11 +431,255 @@ def test_missing_dest_dir(capsys):
     assert 'DEST_DIR is required' in out + err
 
 
+@pytest.fixture
+def ruby_tarball(tmpdir):
+    root = tmpdir.join('src/ruby-2.3.1')
+    ruby = root.join('bin/ruby').ensure()
+    ruby.write('#!/usr/bin/env bash\necho hello\n')
+    ruby.chmod(0o755)
+    os.link(ruby, root.join('bin/ruby2.3'))
+    root.join('bin/gem').write('#!/usr/bin/env ruby\n')
+    os.symlink('ruby', root.join('bin/irb'))
+    root.join('lib/ruby/gems/2.3.0/cache/sass-3.4.22.gem').ensure()
+    tar_filename = tmpdir.join('ruby-2.3.1.tar.bz2')
+    with tarfile.open(tar_filename.strpath, 'w:bz2') as tar_file:
+        tar_file.add(root.strpath, 'ruby-2.3.1')
+    yield tar_filename
+
+
+@pytest.fixture
+def downloads_ruby_tarball(ruby_tarball):
+    with mock.patch.object(
+            urllib.request, 'urlopen', return_value=ruby_tarball.open('rb'),
+    ) as mck:
+        yield mck
+
+
+@pytest.fixture
+def cached_ruby_tarball(mocked_cache, ruby_tarball):
+    cached = mocked_cache.join('ubuntu/16.04/x86_64/ruby-2.3.1.tar.bz2')
+    ruby_tarball.copy(cached.dirpath().ensure_dir())
+    yield cached
+
+
+def _fake_bunzip2(path, returncode=0):
+    # stands in for lbzip2 / pbzip2, which take the same arguments
+    code = (
+        'import bz2, shutil, sys; '
+        'shutil.copyfileobj(bz2.open(sys.stdin.buffer), sys.stdout.buffer)'
+    )
+    path.write(
+        f'#!/usr/bin/env bash\n'
+        f'{shlex.quote(sys.executable)} -c {shlex.quote(code)} || exit\n'
+        f'exit {returncode}\n',
+    )
+    path.chmod(0o755)
+    return path.strpath
+
+
+@pytest.mark.usefixtures('xenial', 'downloads_ruby_tarball')
+def test_make_environment(tmpdir, mocked_cache, ruby_tarball):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv')
+    assert not rubyvenv.make_environment(env.strpath, version)
+
+    assert env.join('bin/ruby').check(file=True)
+    assert os.access(env.join('bin/ruby').strpath, os.X_OK)
+    assert env.join('bin/ruby2.3').samefile(env.join('bin/ruby'))
+    assert os.readlink(env.join('bin/irb')) == 'ruby'
+    assert env.join('lib/ruby/gems/2.3.0').check(dir=True)
+    assert not env.join('lib/ruby/gems/2.3.0/cache').exists()
+    assert env.join('bin/activate').check(file=True)
+    assert env.join('.gitignore').check(file=True)
+
+    cached = mocked_cache.join('ubuntu/16.04/x86_64/ruby-2.3.1.tar.bz2')
+    assert cached.read_binary() == ruby_tarball.read_binary()
+
+
+@pytest.mark.usefixtures('xenial', 'downloads_ruby_tarball')
+def test_make_environment_already_extracted(tmpdir):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv')
+    assert not rubyvenv.make_environment(env.strpath, version)
+    assert env.join('.rubyvenv-version').read() == version.url
+
+    env.join('bin/activate').remove()
+    with mock.patch.object(
+            rubyvenv, 'open_cache_file', side_effect=AssertionError,
+    ):
+        assert not rubyvenv.make_environment(env.strpath, version)
+    assert env.join('bin/activate').check(file=True)
+
+
+@pytest.mark.usefixtures('xenial', 'downloads_ruby_tarball')
+def test_make_environment_different_version_extracted(tmpdir):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv').ensure_dir()
+    env.join('.rubyvenv-version').write(
+        'https://rvm.io/binaries/ubuntu/16.04/x86_64/ruby-2.3.0.tar.bz2',
+    )
+    assert not rubyvenv.make_environment(env.strpath, version)
+    assert env.join('bin/ruby').check(file=True)
+    assert env.join('.rubyvenv-version').read() == version.url
+
+
+def test_extract_members_directory_attributes(tmpdir):
+    tar_filename = tmpdir.join('ruby-2.3.1.tar.bz2')
+    with tarfile.open(tar_filename.strpath, 'w:bz2') as tar_file:
+        for name, mode in (('ruby-2.3.1', 0o755), ('ruby-2.3.1/ro', 0o555)):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = mode
+            info.mtime = 1000000
+            tar_file.addfile(info)
+        for name in ('ruby-2.3.1/ro/f', 'ruby-2.3.1/no-dir-entry/f'):
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            tar_file.addfile(info, io.BytesIO(b'hi\n'))
+
+    dest = tmpdir.join('rubyvenv')
+    with tarfile.open(tar_filename.strpath, 'r|bz2') as tar_file:
+        members = rubyvenv._tar_members(tar_file)
+        rubyvenv._extract_members(tar_file, members, dest.strpath)
+
+    assert dest.join('ro/f').read() == 'hi\n'
+    assert dest.join('no-dir-entry/f').read() == 'hi\n'
+    # the data filter leaves directory permissions at the default
+    if hasattr(tarfile, 'data_filter'):
+        expected_mode = 0o755
+    else:
+        expected_mode = 0o555
+    assert stat.S_IMODE(dest.join('ro').stat().mode) == expected_mode
+    # not clobbered by writing the files inside
+    assert dest.join('ro').mtime() == 1000000
+    assert dest.mtime() == 1000000
+
+
+def test_extract_members_outside_dest(tmpdir):
+    tar_filename = tmpdir.join('ruby-2.3.1.tar.bz2')
+    with tarfile.open(tar_filename.strpath, 'w:bz2') as tar_file:
+        info = tarfile.TarInfo('ruby-2.3.1/../../escaped')
+        info.size = 3
+        tar_file.addfile(info, io.BytesIO(b'hi\n'))
+
+    dest = tmpdir.join('a/rubyvenv')
+    with tarfile.open(tar_filename.strpath, 'r|bz2') as tar_file:
+        members = rubyvenv._tar_members(tar_file)
+        with pytest.raises(tarfile.TarError):
+            rubyvenv._extract_members(tar_file, members, dest.strpath)
+
+    assert not tmpdir.join('escaped').exists()
+    assert not tmpdir.join('a/escaped').exists()
+
+
+@pytest.mark.skipif(
+    not hasattr(tarfile, 'data_filter'), reason='needs the data filter',
+)
+def test_extract_members_strips_setuid(tmpdir):
+    tar_filename = tmpdir.join('ruby-2.3.1.tar.bz2')
+    with tarfile.open(tar_filename.strpath, 'w:bz2') as tar_file:
+        info = tarfile.TarInfo('ruby-2.3.1/bin/ruby')
+        info.mode = 0o4755
+        info.size = 3
+        tar_file.addfile(info, io.BytesIO(b'hi\n'))
+
+    dest = tmpdir.join('rubyvenv')
+    with tarfile.open(tar_filename.strpath, 'r|bz2') as tar_file:
+        members = rubyvenv._tar_members(tar_file)
+        rubyvenv._extract_members(tar_file, members, dest.strpath)
+
+    assert stat.S_IMODE(dest.join('bin/ruby').stat().mode) == 0o755
+
+
+def test_filter_member_without_data_filter(monkeypatch):
+    monkeypatch.delattr(tarfile, 'data_filter', raising=False)
+    member = tarfile.TarInfo('bin/ruby')
+    assert rubyvenv._filter_member(member, 'dest') is member
+    for name in ('../escaped', 'bin/../../escaped', '/escaped'):
+        with pytest.raises(tarfile.ExtractError):
+            rubyvenv._filter_member(tarfile.TarInfo(name), 'dest')
+
+
+@pytest.mark.usefixtures('xenial', 'downloads_ruby_tarball')
+def test_make_environment_extraction_fails(tmpdir):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv').ensure_dir()
+    sentinel = env.join('.rubyvenv-version')
+    sentinel.write(
+        'https://rvm.io/binaries/ubuntu/16.04/x86_64/ruby-2.3.0.tar.bz2',
+    )
+    with mock.patch.object(
+            rubyvenv, '_extract_members', side_effect=BoomError,
+    ):
+        with pytest.raises(BoomError):
+            rubyvenv.make_environment(env.strpath, version)
+    assert not sentinel.exists()
+
+
+@pytest.mark.usefixtures('xenial', 'downloads_ruby_tarball')
+def test_make_environment_small_extract_buffer(tmpdir):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv')
+    with mock.patch.object(rubyvenv, 'EXTRACT_BUFFER_SIZE', 0):
+        assert not rubyvenv.make_environment(env.strpath, version)
+    assert env.join('bin/ruby').read() == '#!/usr/bin/env bash\necho hello\n'
+
+
+@pytest.mark.usefixtures('xenial', 'cached_ruby_tarball')
+def test_make_environment_cached(tmpdir):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv')
+    with mock.patch.object(urllib.request, 'urlopen') as urlopen:
+        assert not rubyvenv.make_environment(env.strpath, version)
+    assert not urlopen.called
+    assert env.join('bin/ruby').check(file=True)
+
+
+@pytest.mark.usefixtures('xenial', 'cached_ruby_tarball')
+def test_make_environment_cached_parallel_bunzip2(tmpdir):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv')
+    bunzip2 = _fake_bunzip2(tmpdir.join('bunzip2'))
+    with mock.patch.object(
+            rubyvenv, '_parallel_bunzip2', return_value=bunzip2,
+    ):
+        with mock.patch.object(
+                subprocess, 'Popen', wraps=subprocess.Popen,
+        ) as popen:
+            assert not rubyvenv.make_environment(env.strpath, version)
+    (args,), _ = popen.call_args
+    assert args == (bunzip2, '--decompress', '--stdout')
+    assert env.join('bin/ruby').check(file=True)
+    assert not env.join('lib/ruby/gems/2.3.0/cache').exists()
+
+
+@pytest.mark.usefixtures('xenial', 'cached_ruby_tarball')
+def test_make_environment_parallel_bunzip2_fails(tmpdir):
+    version = rubyvenv.pick_version('2.3.1')
+    env = tmpdir.join('rubyvenv')
+    bunzip2 = _fake_bunzip2(tmpdir.join('bunzip2'), returncode=1)
+    with mock.patch.object(
+            rubyvenv, '_parallel_bunzip2', return_value=bunzip2,
+    ):
+        with pytest.raises(subprocess.CalledProcessError):
+            rubyvenv.make_environment(env.strpath, version)
+
+
+def test_parallel_bunzip2_not_installed():
+    with mock.patch.object(shutil, 'which', return_value=None):
+        assert rubyvenv._parallel_bunzip2() is None
+
+
+def test_parallel_bunzip2_installed():
+    with mock.patch.object(shutil, 'which', return_value='/bin/lbzip2'):
+        assert rubyvenv._parallel_bunzip2() == '/bin/lbzip2'
+
+
 def _run(env, sh):
-    return subprocess.check_output((
-        'bash', '-euc',
-        f'PS1="$ "; . {env}/bin/activate; {sh}',
-    )).decode('UTF-8')
+    return subprocess.run(
+        ('bash', '-euc', f'PS1="$ "; . {env}/bin/activate; {sh}'),
+        check=True, stdout=subprocess.PIPE, text=True,
+    ).stdout
 
 
 @pytest.mark.usefixtures('mocked_cache')